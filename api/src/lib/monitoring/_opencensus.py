@@ -0,0 +1,496 @@
+"""
+OpenCensus subclasses used by app_insights.
+
+Kept in a separate module so app_insights can import it (and OpenCensus)
+lazily from init_app_insights().
+"""
+
+import contextvars
+import gzip
+import json
+import logging
+import queue
+import random
+import time
+from typing import Any, Callable, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from opencensus.ext.azure.common.transport import (
+    REDIRECT_STATUS_CODES,
+    RETRYABLE_STATUS_CODES,
+    THROTTLE_STATUS_CODES,
+    TransportStatusCode,
+    _update_requests_map,
+)
+from opencensus.ext.azure.log_exporter import AzureLogHandler
+from opencensus.ext.azure.metrics_exporter import MetricsExporter, standard_metrics
+from opencensus.ext.azure.trace_exporter import AzureExporter
+from opencensus.metrics import transport as metrics_transport
+from opencensus.stats import stats as stats_module
+from opencensus.trace import blank_span, execution_context
+from opencensus.trace import span_context as span_context_module
+from opencensus.trace import tracer as tracer_module
+from opencensus.trace.tracers import context_tracer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional: pip install orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Same limit as the stock transport, to stop circular redirects
+_MAX_CONSECUTIVE_REDIRECTS = 10
+
+# How often a blocked CompressedLogHandler.emit() checks its worker and
+# drain deadline (seconds)
+_EMIT_POLL_INTERVAL = 0.25
+
+# Shared by every exporter so batches reuse pooled keep-alive connections
+# instead of paying a TLS handshake per export. Retry only covers
+# connection failures (urllib3 does not retry POST on read/status errors).
+# Batches that still fail get TransportStatusCode.RETRY from _transmit,
+# which the exporters keep in local storage when it is enabled.
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    ),
+)
+
+
+def _dumps_envelopes(envelopes: List[Any]) -> bytes:
+    """
+    Serialize envelopes to UTF-8 JSON, using orjson when installed.
+
+    Unknown values (Decimal, arbitrary objects) are written as str(), like
+    the stock transport, so one bad property can't sink the whole batch.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(envelopes, default=str)
+        except TypeError:
+            # e.g. ints wider than 64 bits or non-str keys; stdlib json copes
+            pass
+    return json.dumps(envelopes, default=str).encode("utf-8")
+
+
+class CompressedTransportMixin:
+    """
+    Transport override for OpenCensus Azure exporters.
+
+    Sends each batch gzip-compressed over the shared session. Mix in ahead
+    of the exporter class so this _transmit wins.
+    """
+
+    def _transmit(self, envelopes: List[Any]) -> int:
+        """
+        Send envelopes to the ingestion endpoint.
+
+        Follows the TransportMixin contract: returns a TransportStatusCode,
+        where RETRY makes the caller keep the batch in local storage.
+        Logs and counts (for statsbeat) each outcome like the stock
+        transport. Never raises.
+        """
+        if not envelopes:
+            return TransportStatusCode.SUCCESS
+
+        # AAD auth and proxies are only handled by the stock transport
+        proxies = getattr(self.options, "proxies", None)
+        if getattr(self.options, "credential", None) or proxies not in (None, "{}"):
+            return super()._transmit(envelopes)
+
+        try:
+            data = gzip.compress(_dumps_envelopes(envelopes))
+        except Exception as e:
+            logger.warning("Error serializing telemetry %s. Dropping telemetry.", e)
+            return TransportStatusCode.DROP
+
+        start_time = time.time()
+        try:
+            response = _session.post(
+                url=self.options.endpoint + "/v2.1/track",
+                data=data,
+                headers={
+                    "Accept": "application/json",
+                    "Content-Type": "application/json; charset=utf-8",
+                    "Content-Encoding": "gzip",
+                },
+                timeout=self.options.timeout,
+                allow_redirects=False,
+            )
+        except requests.Timeout as e:
+            logger.warning("Request time out. Ingestion may be backed up. Retrying.")
+            self._count_request(start_time, "exception", type(e).__name__)
+            return TransportStatusCode.RETRY
+        except requests.RequestException as e:
+            logger.warning("Retrying due to transient client side error %s.", e)
+            self._count_request(start_time, "exception", type(e).__name__)
+            return TransportStatusCode.RETRY
+
+        status_code = response.status_code
+
+        if status_code == 200:
+            self._consecutive_redirects = 0
+            self._count_request(start_time, "success")
+            return TransportStatusCode.SUCCESS
+
+        if status_code == 206:
+            # Partial success: store only the envelopes worth retrying
+            self._count_request(start_time)
+            try:
+                errors = response.json().get("errors", [])
+            except ValueError as e:
+                logger.warning("Error while reading response body %s for partial content.", e)
+                return TransportStatusCode.DROP
+            resend = []
+            for error in errors:
+                index = error.get("index", -1)
+                if not 0 <= index < len(envelopes):
+                    continue
+                if error.get("statusCode") in RETRYABLE_STATUS_CODES:
+                    resend.append(envelopes[index])
+                else:
+                    logger.error(
+                        "Data drop %s: %s %s.",
+                        error.get("statusCode"),
+                        error.get("message"),
+                        envelopes[index],
+                    )
+            if resend and self.storage:
+                self.storage.put(resend)
+            return TransportStatusCode.DROP
+
+        if status_code in REDIRECT_STATUS_CODES:
+            # Follow the ingestion endpoint to its new host, as the stock transport does
+            self._consecutive_redirects += 1
+            location = urlparse(response.headers.get("location", ""))
+            can_follow = location.scheme and location.netloc
+            if can_follow and self._consecutive_redirects < _MAX_CONSECUTIVE_REDIRECTS:
+                self.options.endpoint = f"{location.scheme}://{location.netloc}"
+                return self._transmit(envelopes)
+            if can_follow:
+                logger.error(
+                    "Error sending telemetry because of circular redirects."
+                    " Please check the integrity of your connection string."
+                )
+            else:
+                logger.error("Error parsing redirect information.")
+            self._count_request(start_time, "exception", "Circular Redirect")
+            return TransportStatusCode.DROP
+
+        if status_code in THROTTLE_STATUS_CODES:
+            # Monthly quota exceeded
+            logger.warning("Telemetry was throttled %s: %s.", status_code, response.text)
+            self._count_request(start_time, "throttle", status_code)
+            return TransportStatusCode.DROP
+
+        if status_code in RETRYABLE_STATUS_CODES:
+            if status_code == 401:
+                logger.warning("Authentication error %s: %s. Retrying.", status_code, response.text)
+            elif status_code == 403:
+                logger.warning("Forbidden error %s: %s. Retrying.", status_code, response.text)
+            else:
+                logger.warning(
+                    "Transient server side error %s: %s. Retrying.", status_code, response.text
+                )
+            self._count_request(start_time, "retry", status_code)
+            return TransportStatusCode.RETRY
+
+        # e.g. 400 (invalid telemetry or iKey) and 404 (wrong regional endpoint)
+        logger.error("Non-retryable server side error %s: %s.", status_code, response.text)
+        self._count_request(start_time, "failure", status_code)
+        return TransportStatusCode.DROP
+
+    def _count_request(
+        self,
+        start_time: float,
+        outcome: Optional[str] = None,
+        value: Any = None
+    ) -> None:
+        """Record a request for statsbeat, as the stock transport does."""
+        if not self._check_stats_collection():
+            return
+        _update_requests_map("count")
+        _update_requests_map("duration", value=time.time() - start_time)
+        if outcome is not None:
+            _update_requests_map(outcome, value=value)
+
+
+class CompressedLogHandler(CompressedTransportMixin, AzureLogHandler):
+    """
+    AzureLogHandler that sends batches through CompressedTransportMixin.
+
+    Meant to sit behind app_insights' queue listener: emit() waits for room
+    in the export queue instead of dropping the record, so a backlog
+    overflows (and is counted) in app_insights' bounded log queue. Once
+    drain_deadline has passed it stops waiting, and records that don't fit
+    are counted in dropped. Records sampled by app_insights carry their
+    sample rate, exported as the envelope's sampleRate.
+    """
+
+    def __init__(self, **options: Any):
+        # time.monotonic() deadline set by app_insights while draining
+        self.drain_deadline: Optional[float] = None
+        # Only emit() writes it, on the queue listener's thread
+        self.dropped = 0
+        super().__init__(**options)
+
+    def log_record_to_envelope(self, record: logging.LogRecord) -> Any:
+        envelope = super().log_record_to_envelope(record)
+        # app_insights sets sample_rate on the records it samples; App
+        # Insights expects a percentage and scales counts by 100 / sampleRate
+        sample_rate = getattr(record, "sample_rate", 1.0)
+        if sample_rate < 1.0:
+            envelope.sampleRate = sample_rate * 100
+        return envelope
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # The stock emit() drops the record with only a warning when full
+        while self._worker.is_alive():
+            timeout = _EMIT_POLL_INTERVAL
+            if self.drain_deadline is not None:
+                timeout = min(timeout, self.drain_deadline - time.monotonic())
+                if timeout <= 0:
+                    break
+            try:
+                self._queue._queue.put(record, timeout=timeout)
+                return
+            except queue.Full:
+                pass
+        # Past the drain deadline, or nothing drains the queue any more
+        try:
+            self._queue._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class CompressedExporter(CompressedTransportMixin, AzureExporter):
+    """AzureExporter (traces) that sends batches through CompressedTransportMixin."""
+
+
+class CompressedMetricsExporter(CompressedTransportMixin, MetricsExporter):
+    """MetricsExporter that sends batches through CompressedTransportMixin."""
+
+
+def new_compressed_metrics_exporter(**options: Any) -> CompressedMetricsExporter:
+    """
+    Build a CompressedMetricsExporter with its export thread.
+
+    Same wiring as opencensus' new_metrics_exporter(), which hard-codes
+    the MetricsExporter class.
+    """
+    exporter = CompressedMetricsExporter(**options)
+    producers = [stats_module.stats]
+    if exporter.options.enable_standard_metrics:
+        producers.append(standard_metrics.producer)
+    exporter.exporter_thread = metrics_transport.get_exporter_thread(
+        producers,
+        exporter,
+        interval=exporter.options.export_interval
+    )
+    if exporter._check_stats_collection():
+        from opencensus.ext.azure.statsbeat import statsbeat
+
+        statsbeat.collect_statsbeat_metrics(exporter.options)
+    return exporter
+
+
+# Number of dropped spans open in the current context (thread/asyncio
+# task). Any span started while it is non-zero is dropped with its root.
+_dropped_depth: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "app_insights_dropped_depth", default=0
+)
+
+class _DroppedBlankSpan(blank_span.BlankSpan):
+    """
+    BlankSpan for spans the sampler dropped.
+
+    Supports the whole span API as no-ops, like the spans of a stock
+    unsampled tracer, but skips BlankSpan.__init__ (which generates a span
+    id) and doesn't collect children.
+    """
+
+    # BlankSpan.__init__'s fields; its methods never mutate them
+    name = "dropped"
+    parent_span = None
+    start_time = None
+    end_time = None
+    span_id = None
+    attributes: dict = {}
+    stack_trace = None
+    annotations = None
+    message_events = None
+    links: list = []
+    status = None
+    same_process_as_parent_span = None
+    _child_spans: list = []
+    context_tracer = None
+    span_kind = None
+
+    def __init__(self):
+        pass
+
+    def span(self, name: str = "child_span") -> "_DroppedBlankSpan":
+        return _DROPPED_BLANK_SPAN
+
+
+# Returned for the children of dropped roots. Integrations may set name or
+# span_kind on it; it is never exported, so sharing one instance is fine.
+_DROPPED_BLANK_SPAN = _DroppedBlankSpan()
+
+
+class _DroppedSpan(_DroppedBlankSpan):
+    """Span for a root the sampler dropped; its children are dropped too."""
+
+    def __init__(self):
+        self._token = None
+
+    def __enter__(self):
+        self._token = _dropped_depth.set(_dropped_depth.get() + 1)
+        return self
+
+    def __exit__(self, *args):
+        _dropped_depth.reset(self._token)
+        return False
+
+
+class SampledTracer(tracer_module.Tracer):
+    """
+    Tracer that makes the sampling decision per root span.
+
+    The stock Tracer asks its sampler once, at construction, so a single
+    process-wide tracer is either always or never sampled, and every span
+    shares one trace id. This one decides when a root span is opened:
+    sampled roots get their own ContextTracer with a fresh trace id, and
+    children join their parent's tracer. Dropped roots are recorded in a
+    ContextVar so their children are dropped too, and no span ids or span
+    data are generated for any of them. on_span_start is called with every
+    sampled span as it starts, whichever caller (helper or integration)
+    opened it.
+
+    span_context, which integrations propagate to downstream services,
+    follows the current root: its ContextTracer's context for sampled
+    roots, and a new unsampled context for dropped ones.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        on_span_start: Optional[Callable[[Any], None]] = None,
+        **kwargs: Any
+    ):
+        self._on_span_start = on_span_start
+        super().__init__(*args, **kwargs)
+
+    @property
+    def span_context(self) -> span_context_module.SpanContext:
+        if _dropped_depth.get():
+            # Only built when an integration propagates from a dropped root
+            return span_context_module.SpanContext(
+                span_id=span_context_module.generate_span_id()
+            )
+        owner = self._current_tracer()
+        if owner is not None:
+            return owner.span_context
+        return self._span_context
+
+    @span_context.setter
+    def span_context(self, value: span_context_module.SpanContext) -> None:
+        # Set by Tracer.__init__; used outside any span
+        self._span_context = value
+
+    def get_tracer(self) -> context_tracer.ContextTracer:
+        # Only used for current_span()/finish(); spans get per-root tracers
+        return context_tracer.ContextTracer(
+            exporter=self.exporter,
+            span_context=self.span_context
+        )
+
+    def span(self, name: str = "span") -> Any:
+        if _dropped_depth.get():
+            return _DROPPED_BLANK_SPAN
+        owner = self._owner_tracer()
+        if owner is None:
+            return _DroppedSpan()
+        return self._started(owner.span(name))
+
+    def start_span(self, name: str = "span") -> Any:
+        if not _dropped_depth.get():
+            owner = self._owner_tracer()
+            if owner is not None:
+                return self._started(owner.start_span(name))
+        _dropped_depth.set(_dropped_depth.get() + 1)
+        return _DROPPED_BLANK_SPAN
+
+    def end_span(self) -> None:
+        depth = _dropped_depth.get()
+        if depth:
+            _dropped_depth.set(depth - 1)
+            return
+        owner = self._current_tracer()
+        if owner is not None:
+            owner.end_span()
+
+    def add_attribute_to_current_span(self, attribute_key: str, attribute_value: Any) -> None:
+        span = execution_context.get_current_span()
+        if not _dropped_depth.get() and span is not None:
+            span.add_attribute(attribute_key, attribute_value)
+
+    def trace_decorator(self) -> Any:
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                self.start_span(name=func.__name__)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.end_span()
+
+            return wrapper
+
+        return decorator
+
+    def _started(self, span: Any) -> Any:
+        """Run the span start callback on a new sampled span."""
+        if self._on_span_start is not None:
+            self._on_span_start(span)
+        return span
+
+    def _current_tracer(self) -> Optional[context_tracer.ContextTracer]:
+        """ContextTracer owning the current span, if any."""
+        span = execution_context.get_current_span()
+        return getattr(span, "context_tracer", None)
+
+    def _owner_tracer(self) -> Optional[context_tracer.ContextTracer]:
+        """
+        ContextTracer a new span should be started on.
+
+        Children join the current span's tracer. Roots are sampled here:
+        None means the root was dropped.
+        """
+        owner = self._current_tracer()
+        if owner is not None:
+            return owner
+
+        rate = getattr(self.sampler, "rate", None)
+        if rate is not None:
+            # Draw before generating any ids
+            if rate < 1.0 and random.random() >= rate:
+                return None
+            root_context = span_context_module.SpanContext()
+        else:
+            root_context = span_context_module.SpanContext()
+            if not self.sampler.should_sample(root_context):
+                return None
+
+        root_context.trace_options.set_enabled(True)
+        return context_tracer.ContextTracer(
+            exporter=self.exporter,
+            span_context=root_context
+        )
@@ -11,30 +11,191 @@ Setup:
 4. Call init_app_insights() at application startup
 5. Install: pip install opencensus-ext-azure opencensus-ext-flask
 
+Per-endpoint sampling (optional):
+    APPINSIGHTS_SAMPLING_RULES="^/health$=0.01;^/api/checkout=1.0;^/api/auth/=1.0"
+    Path regex=rate pairs separated by ";", first match wins. Requests that
+    fail (status >= 400 or exception) are always tracked. Merged with rules
+    added earlier through set_sample_rate(); for the same regex the env
+    var's rate wins.
+
 Azure Portal: https://portal.azure.com
 Pricing: 5GB/month free, then ~$2.30/GB
 """
 
+import atexit
+import contextvars
 import logging
+import logging.handlers
+import math
 import os
-from typing import Any, Dict, Optional
-
-from opencensus.ext.azure import metrics_exporter
-from opencensus.ext.azure.log_exporter import AzureLogHandler
-from opencensus.ext.azure.trace_exporter import AzureExporter
-from opencensus.stats import aggregation as aggregation_module
-from opencensus.stats import measure as measure_module
-from opencensus.stats import stats as stats_module
-from opencensus.stats import view as view_module
-from opencensus.tags import tag_map as tag_map_module
-from opencensus.trace import config_integration
-from opencensus.trace.samplers import ProbabilitySampler
-from opencensus.trace.tracer import Tracer
+import queue
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, FrozenSet, List, Optional, Pattern, Tuple
+
+# OpenCensus (and the requests/exporter stack it pulls in) is imported
+# lazily in init_app_insights() and the metric helpers, so importing this
+# module stays cheap for processes that never enable telemetry.
+if TYPE_CHECKING:
+    from opencensus.ext.azure.metrics_exporter import MetricsExporter
+    from opencensus.stats.measure import MeasureFloat
+    from opencensus.stats.stats import _Stats
+    from opencensus.stats.view import View
+    from opencensus.trace.tracer import Tracer
+
+    from ._opencensus import CompressedLogHandler
 
 # Global instances
-_tracer: Optional[Tracer] = None
-_metrics_exporter: Optional[metrics_exporter.MetricsExporter] = None
+_tracer: Optional["Tracer"] = None
+_metrics_exporter: Optional["MetricsExporter"] = None
 _logger: Optional[logging.Logger] = None
+_log_queue: Optional["_MeteredQueue"] = None
+_queue_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+_log_handler: Optional["CompressedLogHandler"] = None
+_sample_rate: float = 1.0
+# (path regex, rate) pairs checked by the middleware, first match wins.
+# Replaced wholesale on update so readers never see a partial list; the
+# lock only serializes writers.
+_endpoint_sample_rules: List[Tuple[Pattern[str], float]] = []
+_sample_rules_lock = threading.Lock()
+# (user_id, account_id) for the current request/task, applied to new spans
+_user_ctx: contextvars.ContextVar[Optional[Tuple[str, Optional[str]]]] = contextvars.ContextVar(
+    "app_insights_user", default=None
+)
+# Severity name -> bound logger method, built once in init_app_insights();
+# exceptions only honour the error-ish levels, anything else logs as ERROR
+_severity_dispatch: Dict[str, Callable[..., None]] = {}
+_exception_dispatch: Dict[str, Callable[..., None]] = {}
+
+# Measures/views registered once per metric name
+_stats: Optional["_Stats"] = None
+_measure_cache: Dict[str, Tuple["MeasureFloat", "View"]] = {}
+_measure_cache_lock = threading.Lock()
+# OpenCensus tag types, resolved in init_app_insights() so track_metric()
+# doesn't import them per call
+_TagKey: Any = None
+_TagValue: Any = None
+
+# Serializes flush()/shutdown(); how long each waits on an exporter (seconds)
+_flush_lock = threading.Lock()
+_FLUSH_TIMEOUT = 5.0
+
+# Max records buffered between request threads and the export thread
+_LOG_QUEUE_SIZE = 20000
+# Records per export batch; the handler's worker sends a batch once it is
+# full or its export_interval has elapsed
+_LOG_MAX_BATCH_SIZE = 512
+
+
+class _MeteredQueue(queue.Queue):
+    """
+    Bounded queue that records its own backpressure.
+
+    Counts records rejected because the queue was full and the deepest
+    the queue has been, both read by _record_queue_metrics().
+    """
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.dropped = 0
+        self.high_water_mark = 0
+
+    def put_nowait(self, item: Any) -> None:
+        if item is None:
+            # QueueListener.stop() enqueues its None sentinel this way; wait
+            # for room so stopping never fails on a full queue
+            self.put(item)
+            return
+        try:
+            super().put_nowait(item)
+        except queue.Full:
+            # Request threads race here when the queue is full
+            with self.mutex:
+                self.dropped += 1
+            raise
+
+    def _put(self, item: Any) -> None:
+        # Called with the queue mutex held, so tracking depth is free here
+        self.queue.append(item)
+        depth = len(self.queue)
+        if depth > self.high_water_mark:
+            self.high_water_mark = depth
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks the caller.
+
+    Records are handed to the export thread untouched so AzureLogHandler
+    still sees exc_info, and a full queue drops the record (counted by
+    _MeteredQueue) instead of stalling the request thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class _NoOpSpan:
+    """Span stand-in returned by start_span() when tracing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add_attribute(self, attribute_key: str, attribute_value: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoOpSpan()
+
+
+@dataclass(slots=True)
+class _Agg:
+    """Running aggregate of one metric/tag combination between flushes."""
+
+    count: int = 0
+    sum: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+    last: float = 0.0
+
+    def update(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.last = value
+
+
+_EMPTY_TAGS: FrozenSet[Tuple[str, str]] = frozenset()
+
+# Joins the derived (<name>/count, ...) and internal (log_queue/...) series
+# names; rejected in track_metric() names, so a user metric never shares a
+# view with one of them
+_SERIES_SEP = "/"
+
+# (metric name, tags) -> aggregate, swapped out by each flush
+_metric_agg: Dict[Tuple[str, FrozenSet[Tuple[str, str]]], _Agg] = {}
+_metric_agg_lock = threading.Lock()
+# Stops the running flusher thread; each init_app_insights() starts a
+# flusher with a fresh event, so a shutdown() never stops a later one
+_metric_flusher_stop = threading.Event()
 
 
 def init_app_insights() -> None:
@@ -43,7 +204,11 @@ def init_app_insights() -> None:
 
     Call this at application startup (e.g., in main.py).
     """
-    global _tracer, _metrics_exporter, _logger
+    global _tracer, _metrics_exporter, _logger, _log_queue, _queue_listener, _queue_handler
+    global _log_handler
+    global _sample_rate
+    global _severity_dispatch, _exception_dispatch, _stats, _TagKey, _TagValue
+    global _metric_flusher_stop
 
     connection_string = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
 
@@ -54,35 +219,154 @@ def init_app_insights() -> None:
     environment = os.getenv("APPINSIGHTS_ENVIRONMENT", os.getenv("NODE_ENV", "development"))
 
     try:
+        from opencensus.stats import stats as stats_module
+        from opencensus.tags.tag_key import TagKey
+        from opencensus.tags.tag_value import TagValue
+        from opencensus.trace import config_integration
+        from opencensus.trace.samplers import ProbabilitySampler
+
+        from ._opencensus import (
+            CompressedExporter,
+            CompressedLogHandler,
+            SampledTracer,
+            new_compressed_metrics_exporter,
+        )
+
         # Configure integrations (automatically instrument libraries)
         config_integration.trace_integrations(['requests', 'sqlalchemy', 'postgresql'])
 
         # Set up trace exporter
         sampling_rate = 0.1 if environment == "production" else 1.0
-        exporter = AzureExporter(connection_string=connection_string)
+        exporter = CompressedExporter(connection_string=connection_string)
         sampler = ProbabilitySampler(rate=sampling_rate)
-
-        _tracer = Tracer(exporter=exporter, sampler=sampler)
+        _sample_rate = sampling_rate
+        # Merged into rules already added with set_sample_rate()
+        _update_sample_rules(_parse_sample_rules(os.getenv("APPINSIGHTS_SAMPLING_RULES", "")))
+
+        _tracer = SampledTracer(
+            exporter=exporter,
+            sampler=sampler,
+            on_span_start=_apply_user,
+        )
 
         # Set up metrics exporter
-        _metrics_exporter = metrics_exporter.new_metrics_exporter(
+        _stats = stats_module.stats
+        _TagKey, _TagValue = TagKey, TagValue
+        _metrics_exporter = new_compressed_metrics_exporter(
             connection_string=connection_string
         )
+        _metric_flusher_stop = threading.Event()
+        threading.Thread(
+            target=_run_metric_flusher,
+            # Record once per export so no window is overwritten unexported
+            args=(_metrics_exporter.export_interval, _metric_flusher_stop),
+            name="app-insights-metrics",
+            daemon=True,
+        ).start()
+
+        # Set up logging (exported from a background thread)
+        _log_queue = _MeteredQueue(maxsize=_LOG_QUEUE_SIZE)
+        _log_handler = CompressedLogHandler(
+            connection_string=connection_string,
+            max_batch_size=_LOG_MAX_BATCH_SIZE,
+        )
+        _queue_listener = logging.handlers.QueueListener(
+            _log_queue,
+            _log_handler,
+            respect_handler_level=True,
+        )
+        _queue_listener.start()
+        atexit.register(shutdown)
 
-        # Set up logging
         _logger = logging.getLogger(__name__)
-        _logger.addHandler(
-            AzureLogHandler(connection_string=connection_string)
-        )
+        _queue_handler = _DroppingQueueHandler(_log_queue)
+        _logger.addHandler(_queue_handler)
         _logger.setLevel(logging.INFO)
 
+        _severity_dispatch = {
+            "CRITICAL": _logger.critical,
+            "ERROR": _logger.error,
+            "WARNING": _logger.warning,
+            "INFO": _logger.info,
+            "DEBUG": _logger.debug,
+        }
+        _exception_dispatch = {
+            "CRITICAL": _logger.critical,
+            "ERROR": _logger.error,
+            "WARNING": _logger.warning,
+        }
+
         print(f"[App Insights] Initialized successfully (environment: {environment})")
 
     except Exception as e:
         print(f"[App Insights] Failed to initialize: {e}")
 
 
-def get_tracer() -> Optional[Tracer]:
+def _parse_sample_rules(spec: str) -> List[Tuple[Pattern[str], float]]:
+    """Parse "regex=rate;regex=rate" into compiled sampling rules."""
+    rules = []
+    for entry in spec.split(";"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        pattern, sep, rate = entry.rpartition("=")
+        try:
+            if not sep:
+                raise ValueError("expected <regex>=<rate>")
+            rules.append((re.compile(pattern), _clamp_rate(float(rate))))
+        except (re.error, ValueError) as e:
+            print(f"[App Insights] Ignoring sampling rule {entry!r}: {e}")
+    return rules
+
+
+def _clamp_rate(rate: float) -> float:
+    """Clamp a sampling rate to [0.0, 1.0]."""
+    return min(max(rate, 0.0), 1.0)
+
+
+def set_sample_rate(pattern: str, rate: float) -> None:
+    """
+    Set the request sampling rate for paths matching a regex.
+
+    Rules are checked in the order they were added; setting an existing
+    pattern again updates its rate in place. Failed requests are always
+    tracked regardless of rate.
+
+    Args:
+        pattern: Regex matched against the request path (e.g., "^/health$")
+        rate: Fraction of matching requests to track (0.0 - 1.0)
+    """
+    _update_sample_rules([(re.compile(pattern), _clamp_rate(rate))])
+
+
+def _update_sample_rules(updates: List[Tuple[Pattern[str], float]]) -> None:
+    """Update the rate of rules whose pattern is already set, append the rest."""
+    global _endpoint_sample_rules
+
+    if not updates:
+        return
+
+    with _sample_rules_lock:
+        rates = {rule.pattern: rate for rule, rate in updates}
+        rules = [
+            (rule, rates.pop(rule.pattern, rule_rate))
+            for rule, rule_rate in _endpoint_sample_rules
+        ]
+        for rule, _ in updates:
+            if rule.pattern in rates:
+                rules.append((rule, rates.pop(rule.pattern)))
+        _endpoint_sample_rules = rules
+
+
+def _match_rate(path: str) -> float:
+    """Return the sampling rate for a request path."""
+    for rule, rate in _endpoint_sample_rules:
+        if rule.search(path):
+            return rate
+    return _sample_rate
+
+
+def get_tracer() -> Optional["Tracer"]:
     """Get the Application Insights tracer instance."""
     return _tracer
 
@@ -108,15 +392,19 @@ def track_event(
     if not _logger:
         return
 
-    extra = {
-        'custom_dimensions': {
-            'event_name': name,
-            **(properties or {}),
-            **(measurements or {})
-        }
-    }
+    # Sample before building any payload
+    if _sample_rate < 1.0 and random.random() >= _sample_rate:
+        return
 
-    _logger.info(f"Event: {name}", extra=extra)
+    custom_dimensions = {'event_name': name}
+    if properties:
+        custom_dimensions.update(properties)
+    if measurements:
+        custom_dimensions.update(measurements)
+    # Exported as the envelope's sampleRate, so counts can be re-weighted
+    extra = {'custom_dimensions': custom_dimensions, 'sample_rate': _sample_rate}
+
+    _logger.info("Event: %s", name, extra=extra)
 
 
 def track_metric(
@@ -131,38 +419,146 @@ def track_metric(
         name: Metric name
         value: Metric value
         properties: Custom properties for filtering
+
+    Raises:
+        ValueError: If the name contains "/", or a property key or value is
+            not a valid OpenCensus tag
     """
     if not _metrics_exporter:
         return
 
-    stats = stats_module.stats
-    view_manager = stats.view_manager
+    if _SERIES_SEP in name:
+        raise ValueError(f"Metric name {name!r} must not contain {_SERIES_SEP!r}")
+
+    tags = _EMPTY_TAGS
+    if properties:
+        # Validate here, so a bad tag fails this call instead of the
+        # background recording of every metric in the interval
+        tags = frozenset((_TagKey(key), _TagValue(value)) for key, value in properties.items())
+
+    # Aggregate in-process; _record_metric_aggregates() hands the
+    # aggregates to OpenCensus once per flush interval
+    key = (name, tags)
+    with _metric_agg_lock:
+        agg = _metric_agg.get(key)
+        if agg is None:
+            agg = _metric_agg[key] = _Agg()
+        agg.update(value)
 
-    # Create measure
-    measure = measure_module.MeasureFloat(name, name, "unit")
 
-    # Create view
-    view = view_module.View(
-        name,
-        name,
-        [],
-        measure,
-        aggregation_module.LastValueAggregation()
+def _record_metric_aggregates() -> None:
+    """
+    Record aggregated metrics into OpenCensus and reset the aggregates.
+
+    Each name/properties combination reports the last value of the interval
+    under the metric's name, and the interval's min/max as <name>/min and
+    <name>/max. <name>/count and <name>/sum are running totals, so they
+    stay correct when a metric goes idle or an interval is never exported.
+    Property keys are the view's columns, so every combination is exported
+    as its own series. OpenCensus can't record negative values, so those
+    measures are skipped for the interval and the rest are still recorded.
+    """
+    global _metric_agg
+
+    with _metric_agg_lock:
+        if not _metric_agg:
+            return
+        pending, _metric_agg = _metric_agg, {}
+
+    from opencensus.tags import tag_map as tag_map_module
+
+    for (name, tags), agg in pending.items():
+        tmap = tag_map_module.TagMap()
+        for tag_key, tag_value in tags:
+            tmap.insert(tag_key, tag_value)
+        columns = sorted(tag_key for tag_key, _ in tags)
+
+        mmap = _stats.stats_recorder.new_measurement_map()
+        for measure, value in (
+            (_get_measure(name, columns), agg.last),
+            (_get_measure(f"{name}/count", columns, cumulative=True), agg.count),
+            (_get_measure(f"{name}/sum", columns, cumulative=True), agg.sum),
+            (_get_measure(f"{name}/min", columns), agg.min),
+            (_get_measure(f"{name}/max", columns), agg.max),
+        ):
+            # OpenCensus refuses to record a map holding any negative value
+            if value >= 0:
+                mmap.measure_float_put(measure, value)
+        mmap.record(tmap)
+
+
+def _record_queue_metrics() -> None:
+    """
+    Report log queue depth and drops so the queue size can be tuned.
+
+    Recorded straight to last-value views: these are already gauges or
+    running totals, so track_metric()'s /count, /sum, /min and /max series
+    would only add noise. Drops include records the export handler gave up
+    on while draining.
+    """
+    if _log_queue is None:
+        return
+
+    dropped = _log_queue.dropped + _log_handler.dropped
+
+    from opencensus.tags import tag_map as tag_map_module
+
+    mmap = _stats.stats_recorder.new_measurement_map()
+    mmap.measure_float_put(_get_measure("log_queue/depth", []), _log_queue.qsize())
+    mmap.measure_float_put(_get_measure("log_queue/dropped_total", []), dropped)
+    mmap.measure_float_put(
+        _get_measure("log_queue/high_water_mark", []), _log_queue.high_water_mark
     )
+    mmap.record(tag_map_module.TagMap())
 
-    # Register view
-    view_manager.register_view(view)
 
-    # Record measurement
-    mmap = stats.stats_recorder.new_measurement_map()
-    tmap = tag_map_module.TagMap()
+def _record_metrics() -> None:
+    """Record log queue metrics and aggregated track_metric() values."""
+    _record_queue_metrics()
+    _record_metric_aggregates()
 
-    if properties:
-        for key, value in properties.items():
-            tmap.insert(key, value)
 
-    mmap.measure_float_put(measure, value)
-    mmap.record(tmap)
+def _run_metric_flusher(interval: float, stop: threading.Event) -> None:
+    """Background loop recording aggregated metrics until stop is set."""
+    while not stop.wait(interval):
+        try:
+            _record_metrics()
+        except Exception as e:
+            print(f"[App Insights] Failed to record metrics: {e}")
+
+
+def _get_measure(name: str, columns: List[str], cumulative: bool = False) -> "MeasureFloat":
+    """
+    Return the measure for a metric, registering its view on first use.
+
+    The view sums every recorded value when cumulative, and keeps the last
+    one otherwise. Its tag columns are fixed by that first call; properties
+    added under other keys later are not exported for the metric.
+    """
+    entry = _measure_cache.get(name)
+    if entry is None:
+        with _measure_cache_lock:
+            entry = _measure_cache.get(name)
+            if entry is None:
+                from opencensus.stats import aggregation as aggregation_module
+                from opencensus.stats import measure as measure_module
+                from opencensus.stats import view as view_module
+
+                measure = measure_module.MeasureFloat(name, name, "unit")
+                view = view_module.View(
+                    name,
+                    name,
+                    columns,
+                    measure,
+                    aggregation_module.SumAggregation()
+                    if cumulative
+                    else aggregation_module.LastValueAggregation()
+                )
+                _stats.view_manager.register_view(view)
+                entry = (measure, view)
+                _measure_cache[name] = entry
+
+    return entry[0]
 
 
 def track_exception(
@@ -181,20 +577,16 @@ def track_exception(
     if not _logger:
         return
 
-    extra = {
-        'custom_dimensions': {
-            'exception_type': type(error).__name__,
-            'exception_message': str(error),
-            **(properties or {})
-        }
+    custom_dimensions = {
+        'exception_type': type(error).__name__,
+        'exception_message': str(error),
     }
+    if properties:
+        custom_dimensions.update(properties)
+    extra = {'custom_dimensions': custom_dimensions}
 
-    if severity == "CRITICAL":
-        _logger.critical(str(error), exc_info=error, extra=extra)
-    elif severity == "WARNING":
-        _logger.warning(str(error), exc_info=error, extra=extra)
-    else:
-        _logger.error(str(error), exc_info=error, extra=extra)
+    log = _exception_dispatch.get(severity, _logger.error)
+    log(str(error), exc_info=error, extra=extra)
 
 
 def track_trace(
@@ -217,16 +609,8 @@ def track_trace(
         'custom_dimensions': properties or {}
     }
 
-    if severity == "DEBUG":
-        _logger.debug(message, extra=extra)
-    elif severity == "WARNING":
-        _logger.warning(message, extra=extra)
-    elif severity == "ERROR":
-        _logger.error(message, extra=extra)
-    elif severity == "CRITICAL":
-        _logger.critical(message, extra=extra)
-    else:
-        _logger.info(message, extra=extra)
+    log = _severity_dispatch.get(severity, _logger.info)
+    log(message, extra=extra)
 
 
 def track_request(
@@ -251,18 +635,43 @@ def track_request(
     if not _logger:
         return
 
-    extra = {
-        'custom_dimensions': {
-            'request_name': name,
-            'url': url,
-            'duration_ms': duration,
-            'response_code': response_code,
-            'success': success,
-            **(properties or {})
-        }
+    # Failed requests are always kept
+    if success and _sample_rate < 1.0 and random.random() >= _sample_rate:
+        return
+
+    _track_request(
+        name, url, duration, response_code, success, properties,
+        sample_rate=_sample_rate if success else 1.0,
+    )
+
+
+def _track_request(
+    name: str,
+    url: str,
+    duration: float,
+    response_code: int,
+    success: bool,
+    properties: Optional[Dict[str, Any]] = None,
+    sample_rate: float = 1.0
+) -> None:
+    """
+    Emit a request record; callers have already made the sampling decision.
+
+    sample_rate is the probability the record was kept with, exported as
+    the envelope's sampleRate.
+    """
+    custom_dimensions = {
+        'request_name': name,
+        'url': url,
+        'duration_ms': duration,
+        'response_code': response_code,
+        'success': success,
     }
+    if properties:
+        custom_dimensions.update(properties)
+    extra = {'custom_dimensions': custom_dimensions, 'sample_rate': sample_rate}
 
-    _logger.info(f"Request: {name}", extra=extra)
+    _logger.info("Request: %s", name, extra=extra)
 
 
 def track_dependency(
@@ -289,19 +698,27 @@ def track_dependency(
     if not _logger:
         return
 
+    # Failed calls are always kept
+    if success and _sample_rate < 1.0 and random.random() >= _sample_rate:
+        return
+
+    custom_dimensions = {
+        'dependency_name': name,
+        'dependency_type': dependency_type,
+        'target': target,
+        'duration_ms': duration,
+        'success': success,
+        'result_code': result_code,
+    }
+    if properties:
+        custom_dimensions.update(properties)
+    # Failed calls were kept regardless of the rate
     extra = {
-        'custom_dimensions': {
-            'dependency_name': name,
-            'dependency_type': dependency_type,
-            'target': target,
-            'duration_ms': duration,
-            'success': success,
-            'result_code': result_code,
-            **(properties or {})
-        }
+        'custom_dimensions': custom_dimensions,
+        'sample_rate': _sample_rate if success else 1.0,
     }
 
-    _logger.info(f"Dependency: {name}", extra=extra)
+    _logger.info("Dependency: %s", name, extra=extra)
 
 
 def set_user(user_id: str, account_id: Optional[str] = None) -> None:
@@ -312,20 +729,34 @@ def set_user(user_id: str, account_id: Optional[str] = None) -> None:
         user_id: User ID
         account_id: Account/tenant ID (optional)
     """
-    # OpenCensus doesn't have direct user context setting
-    # Instead, add user_id to all subsequent events via properties
+    # OpenCensus doesn't have direct user context setting.
+    # Instead, keep it in a context variable (scoped to the current
+    # request/asyncio task); the tracer stamps it on each span as it
+    # starts, and the span that is already open (e.g., the request span)
+    # is tagged here.
+    _user_ctx.set((user_id, account_id))
+
     if _tracer:
         span = _tracer.current_span()
-        if span:
-            span.add_attribute("user_id", user_id)
-            if account_id:
-                span.add_attribute("account_id", account_id)
+        if span is not None:
+            _apply_user(span)
 
 
 def clear_user() -> None:
     """Clear user context (e.g., on logout)."""
-    # OpenCensus handles this per-span, no global clear needed
-    pass
+    _user_ctx.set(None)
+
+
+def _apply_user(span: Any) -> None:
+    """Add the current user context to a span, if a user is set."""
+    user = _user_ctx.get()
+    if user is None:
+        return
+
+    user_id, account_id = user
+    span.add_attribute("user_id", user_id)
+    if account_id:
+        span.add_attribute("account_id", account_id)
 
 
 def start_span(name: str) -> Any:
@@ -339,25 +770,120 @@ def start_span(name: str) -> Any:
         Span context manager
     """
     if not _tracer:
-        # Return a no-op context manager
-        class NoOpSpan:
-            def __enter__(self):
-                return self
-            def __exit__(self, *args):
-                pass
-
-        return NoOpSpan()
+        return _NOOP_SPAN
 
     return _tracer.span(name=name)
 
 
 def flush() -> None:
     """Flush all pending telemetry."""
-    if _tracer:
-        _tracer.exporter.export(_tracer.exporter.queue)
+    with _flush_lock:
+        if _queue_listener:
+            _drain_log_queue()
+            _queue_listener.start()
+
+        if _tracer:
+            _sync_exporter_queue(_tracer.exporter)
+
+        if _metrics_exporter:
+            _record_metrics()
+            _metrics_exporter.export_metrics(_stats.get_metrics())
+
+
+def shutdown() -> None:
+    """
+    Flush all pending telemetry and stop the background exporters.
+
+    Registered with atexit by init_app_insights(); safe to call more than once.
+    track_* calls made afterwards are ignored until init_app_insights() runs again.
+    """
+    global _queue_listener, _queue_handler, _logger, _metrics_exporter
+
+    with _flush_lock:
+        if _queue_listener:
+            # Detach first, so later records aren't queued where nothing
+            # exports them
+            _logger.removeHandler(_queue_handler)
+            _queue_handler = None
+            _logger = None
+            _drain_log_queue()
+            _queue_listener = None
+
+        if _tracer:
+            _sync_exporter_queue(_tracer.exporter)
+
+        if _metrics_exporter:
+            _metric_flusher_stop.set()
+            _record_metrics()
+            # Exports the final metric snapshot and stops the export thread
+            _metrics_exporter.shutdown()
+            # The exporter's own atexit hook would export that snapshot again
+            atexit.unregister(_metrics_exporter.shutdown)
+            _metrics_exporter = None
+
+
+def _drain_log_queue() -> None:
+    """
+    Stop the queue listener once every queued record reached the handlers.
+
+    Takes at most about _FLUSH_TIMEOUT: past it, the export handler stops
+    waiting for room in its queue and drops (and counts) what doesn't fit.
+    """
+    deadline = time.monotonic() + _FLUSH_TIMEOUT
+    _log_handler.drain_deadline = deadline
+    try:
+        # stop() enqueues a sentinel behind pending records and joins the thread
+        _queue_listener.stop()
+    finally:
+        _log_handler.drain_deadline = None
+    for handler in _queue_listener.handlers:
+        if hasattr(handler, "_queue"):
+            _sync_exporter_queue(handler, max(deadline - time.monotonic(), 0.0))
+        else:
+            handler.flush()
+
+
+def _sync_exporter_queue(exporter: Any, timeout: float = _FLUSH_TIMEOUT) -> None:
+    """
+    Block until an OpenCensus exporter has sent everything queued so far.
+
+    opencensus' Queue.flush() returns at once when the queue looks empty,
+    which is the usual case: the worker has already pulled pending items
+    into the batch it is waiting to fill. A sync event on the queue ends
+    that batch, and the worker sets the event once it has been exported.
+    """
+    worker = getattr(exporter, "_worker", None)
+    if worker is None or not worker.is_alive():
+        return
+
+    from opencensus.common.schedule import QueueEvent
+
+    event = QueueEvent("SYNC")
+    exporter._queue.put(event, block=True, timeout=timeout)
+    event.wait(timeout)
+
 
-    if _metrics_exporter:
-        _metrics_exporter.export_metrics(_metrics_exporter.queue)
+def _record_error(method: str, path: str, error: Exception, duration: float) -> None:
+    """
+    Record an unhandled request exception.
+
+    Builds the request context once, sends it to App Insights, and attaches
+    the same dict to the current Sentry scope (when sentry-sdk is installed)
+    so the event the Sentry FastAPI integration captures for this exception
+    carries it too, without a second capture.
+    """
+    context = {
+        "method": method,
+        "path": path,
+        "duration_ms": duration,
+    }
+    track_exception(error, severity="ERROR", properties=context)
+
+    try:
+        import sentry_sdk
+    except ImportError:
+        return
+    sentry_sdk.set_context("request_telemetry", context)
 
 
 # FastAPI middleware integration
@@ -373,34 +899,43 @@ def get_fastapi_middleware():
         app.middleware("http")(get_fastapi_middleware())
     """
     async def app_insights_middleware(request, call_next):
-        import time
+        if not _logger:
+            return await call_next(request)
+
+        path = request.url.path
+        method = request.method
 
-        start_time = time.time()
+        # Head sampling per endpoint; unsampled requests skip payload building
+        rate = _match_rate(path)
+        sampled = rate >= 1.0 or random.random() < rate
+        start_time = time.perf_counter()
 
         try:
             response = await call_next(request)
-            duration = (time.time() - start_time) * 1000  # Convert to ms
+        except Exception as e:
+            # Exceptions are always tracked, sampled or not
+            _record_error(method, path, e, (time.perf_counter() - start_time) * 1000)
+            raise
 
-            track_request(
-                name=f"{request.method} {request.url.path}",
-                url=str(request.url),
+        # Failed requests are always tracked
+        success = response.status_code < 400
+        if sampled or not success:
+            duration = (time.perf_counter() - start_time) * 1000  # Convert to ms
+
+            _track_request(
+                name=f"{method} {path}",
+                # Only sampled requests pay for rebuilding the full URL
+                url=str(request.url) if sampled else path,
                 duration=duration,
                 response_code=response.status_code,
-                success=response.status_code < 400,
+                success=success,
                 properties={
-                    "method": request.method,
-                    "path": request.url.path,
-                }
+                    "method": method,
+                    "path": path,
+                },
+                sample_rate=rate if success else 1.0,
             )
 
-            return response
-
-        except Exception as e:
-            duration = (time.time() - start_time) * 1000
-            track_exception(e, severity="ERROR", properties={
-                "method": request.method,
-                "path": request.url.path,
-            })
-            raise
+        return response
 
     return app_insights_middleware
@@ -13,12 +13,52 @@ Setup:
 """
 
 import os
+import re
 from typing import Any, Dict, Optional
 
 import sentry_sdk
-from sentry_sdk.integrations.fastapi import FastApiIntegration
-from sentry_sdk.integrations.starlette import StarletteIntegration
-from sentry_sdk.integrations.sqlalchemy import SqlAlchemyIntegration
+
+try:
+    import ahocorasick  # optional: pip install pyahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Request headers stripped from every event
+_SENSITIVE_HEADERS = frozenset({"authorization", "cookie", "x-api-key"})
+
+# Extra keys whose values are redacted
+_SENSITIVE_RE = re.compile(r"password|secret|token|api[_-]?key", re.IGNORECASE)
+
+# Outbound HTTP breadcrumbs to analytics/tracking services
+_TRACKING_KEYWORDS = ("analytics", "tracking", "segment", "mixpanel")
+_TRACKING_RE = re.compile("|".join(map(re.escape, _TRACKING_KEYWORDS)))
+
+if ahocorasick is not None:
+    _TRACKING_AUTOMATON = ahocorasick.Automaton()
+    for _keyword in _TRACKING_KEYWORDS:
+        _TRACKING_AUTOMATON.add_word(_keyword, _keyword)
+    _TRACKING_AUTOMATON.make_automaton()
+
+    def _is_tracking_url(url: str) -> bool:
+        """Check a URL for tracking keywords in one Aho-Corasick pass."""
+        return next(_TRACKING_AUTOMATON.iter(url), None) is not None
+else:
+    def _is_tracking_url(url: str) -> bool:
+        """Check a URL for tracking keywords with the compiled regex."""
+        return _TRACKING_RE.search(url) is not None
+
+# Accepted level names -> Sentry level, so callers can pass App Insights
+# style severities ("CRITICAL", "WARN") without per-call string handling
+_LEVELS = {
+    "debug": "debug",
+    "info": "info",
+    "warning": "warning",
+    "warn": "warning",
+    "error": "error",
+    "fatal": "fatal",
+    "critical": "fatal",
+}
+_LEVELS.update({name.upper(): level for name, level in _LEVELS.items()})
 
 
 def init_sentry() -> None:
@@ -35,6 +75,12 @@ def init_sentry() -> None:
 
     environment = os.getenv("SENTRY_ENVIRONMENT", os.getenv("NODE_ENV", "development"))
 
+    # Imported here so the FastAPI/Starlette/SQLAlchemy stacks only load
+    # when Sentry is actually enabled
+    from sentry_sdk.integrations.fastapi import FastApiIntegration
+    from sentry_sdk.integrations.sqlalchemy import SqlAlchemyIntegration
+    from sentry_sdk.integrations.starlette import StarletteIntegration
+
     sentry_sdk.init(
         dsn=dsn,
         environment=environment,
@@ -79,9 +125,8 @@ def before_send_filter(event: Dict[str, Any], hint: Dict[str, Any]) -> Optional[
         # Remove authorization headers
         if "headers" in request:
             headers = request["headers"]
-            headers.pop("authorization", None)
-            headers.pop("cookie", None)
-            headers.pop("x-api-key", None)
+            for header in _SENSITIVE_HEADERS:
+                headers.pop(header, None)
 
         # Sanitize query string
         if "query_string" in request:
@@ -95,9 +140,9 @@ def before_send_filter(event: Dict[str, Any], hint: Dict[str, Any]) -> Optional[
     # Remove sensitive extra data
     if "extra" in event:
         extra = event["extra"]
-        # Remove password fields
-        for key in list(extra.keys()):
-            if "password" in key.lower() or "secret" in key.lower():
+        # Remove password/secret/token fields
+        for key in extra:
+            if _SENSITIVE_RE.search(key):
                 extra[key] = "[REDACTED]"
 
     # Remove sensitive context
@@ -137,7 +182,7 @@ def before_breadcrumb_filter(crumb: Dict[str, Any], hint: Dict[str, Any]) -> Opt
     # Don't track HTTP requests to analytics/tracking services
     if crumb.get("category") == "httplib":
         url = crumb.get("data", {}).get("url", "")
-        if any(x in url for x in ["analytics", "tracking", "segment", "mixpanel"]):
+        if _is_tracking_url(url):
             return None
 
     return crumb
@@ -162,23 +207,11 @@ def capture_error(
         extra: Extra data for debugging
         level: Severity level (debug, info, warning, error, fatal)
     """
-    with sentry_sdk.push_scope() as scope:
-        if user:
-            scope.set_user(user)
-
-        if tags:
-            for key, value in tags.items():
-                scope.set_tag(key, value)
-
-        if extra:
-            for key, value in extra.items():
-                scope.set_extra(key, value)
-
-        if context:
-            scope.set_context("custom", context)
-
-        scope.set_level(level)
-        sentry_sdk.capture_exception(error)
+    sentry_sdk.capture_exception(
+        error,
+        level=_LEVELS.get(level, level),
+        **_event_scope(user=user, tags=tags, extra=extra, context=context),
+    )
 
 
 def capture_message(
@@ -196,17 +229,75 @@ def capture_message(
         tags: Tags for filtering/grouping
         extra: Extra data
     """
-    with sentry_sdk.push_scope() as scope:
-        if tags:
-            for key, value in tags.items():
-                scope.set_tag(key, value)
+    sentry_sdk.capture_message(
+        message,
+        level=_LEVELS.get(level, level),
+        **_event_scope(tags=tags, extra=extra),
+    )
+
+
+def enrich_scope(
+    user: Optional[Dict[str, str]] = None,
+    tags: Optional[Dict[str, str]] = None,
+    extra: Optional[Dict[str, Any]] = None,
+    context: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Add context to the current scope in place.
+
+    Inside a request handled by the FastAPI integration this is the
+    request's own scope, so the data is attached to every event captured
+    for the rest of that request. Use capture_error()/capture_message()
+    arguments for data that belongs to a single event.
+
+    Args:
+        user: User information (id, email, username)
+        tags: Tags for filtering/grouping
+        extra: Extra data for debugging
+        context: Additional context dict
+    """
+    if user:
+        sentry_sdk.set_user(user)
+
+    if tags:
+        for key, value in tags.items():
+            sentry_sdk.set_tag(key, value)
+
+    if extra:
+        for key, value in extra.items():
+            sentry_sdk.set_extra(key, value)
+
+    if context:
+        sentry_sdk.set_context("custom", context)
+
+
+def _event_scope(
+    user: Optional[Dict[str, str]] = None,
+    tags: Optional[Dict[str, str]] = None,
+    extra: Optional[Dict[str, Any]] = None,
+    context: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Build scope kwargs for sentry_sdk.capture_*().
+
+    The SDK merges them into a copy of the current scope for that one
+    event, so nothing leaks into later events of the same request.
+    """
+    scope_kwargs: Dict[str, Any] = {}
+
+    if user:
+        scope_kwargs["user"] = user
+
+    if tags:
+        scope_kwargs["tags"] = tags
+
+    if extra:
+        scope_kwargs["extras"] = extra
 
-        if extra:
-            for key, value in extra.items():
-                scope.set_extra(key, value)
+    if context:
+        scope_kwargs["contexts"] = {"custom": context}
 
-        scope.set_level(level)
-        sentry_sdk.capture_message(message)
+    return scope_kwargs
 
 
 def set_user(user_id: str, email: Optional[str] = None, username: Optional[str] = None) -> None:
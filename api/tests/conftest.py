@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules live under api/src and are imported as lib.*
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
@@ -0,0 +1,437 @@
+"""flush() round trip through the real OpenCensus exporters."""
+
+import asyncio
+import gzip
+import json
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("opencensus.ext.azure")
+
+from lib.monitoring import _opencensus, app_insights  # noqa: E402
+
+
+@pytest.fixture
+def posted(monkeypatch, tmp_path):
+    """Initialize App Insights against a fake ingestion endpoint."""
+    envelopes = []
+    lock = threading.Lock()
+
+    def fake_post(url, data, **kwargs):
+        with lock:
+            envelopes.extend(json.loads(gzip.decompress(data)))
+        return SimpleNamespace(status_code=200)
+
+    monkeypatch.setenv(
+        "APPLICATIONINSIGHTS_CONNECTION_STRING",
+        "InstrumentationKey=00000000-0000-0000-0000-000000000000",
+    )
+    # Exporters keep local storage under the temp dir; isolate it per test
+    # so batches stored by one run are never resent into another
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    monkeypatch.setenv("APPLICATIONINSIGHTS_STATSBEAT_DISABLED_ALL", "true")
+    monkeypatch.setattr(_opencensus._session, "post", fake_post)
+
+    app_insights.init_app_insights()
+    assert app_insights.get_logger() is not None
+
+    yield envelopes
+
+    app_insights.shutdown()
+    monkeypatch.setattr(app_insights, "_tracer", None)
+
+
+def _messages(envelopes):
+    return [
+        e["data"]["baseData"]["message"]
+        for e in envelopes
+        if e["data"]["baseType"] == "MessageData"
+    ]
+
+
+def _span_names(envelopes):
+    return [
+        e["data"]["baseData"]["name"]
+        for e in envelopes
+        if e["data"]["baseType"] in ("RemoteDependencyData", "RequestData")
+    ]
+
+
+def test_flush_sends_tracked_events(posted):
+    # The exporters' 15 s export interval outlasts the test, so anything
+    # received here was sent by flush()
+    for i in range(50):
+        app_insights.track_event(f"event-{i}")
+        with app_insights.start_span(f"span-{i}"):
+            pass
+
+    app_insights.flush()
+
+    assert sorted(_messages(posted)) == sorted(f"Event: event-{i}" for i in range(50))
+    assert sorted(_span_names(posted)) == sorted(f"span-{i}" for i in range(50))
+
+
+def test_concurrent_flushes(posted):
+    app_insights.track_event("event")
+    errors = []
+
+    def flush():
+        try:
+            app_insights.flush()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=flush) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert _messages(posted) == ["Event: event"]
+
+    # The listener was restarted, so records tracked afterwards still export
+    app_insights.track_event("after")
+    app_insights.flush()
+    assert _messages(posted) == ["Event: event", "Event: after"]
+
+
+def test_user_is_added_to_spans_opened_by_integrations(posted):
+    tracer = app_insights.get_tracer()
+
+    with app_insights.start_span("request"):
+        app_insights.set_user("user-1", "account-1")
+        # What the requests/sqlalchemy integrations do
+        tracer.start_span("query")
+        tracer.end_span()
+    app_insights.clear_user()
+
+    app_insights.flush()
+
+    properties = {
+        e["data"]["baseData"]["name"]: e["data"]["baseData"].get("properties", {})
+        for e in posted
+        if e["data"]["baseType"] in ("RemoteDependencyData", "RequestData")
+    }
+    for name in ("request", "query"):
+        assert properties[name]["user_id"] == "user-1"
+        assert properties[name]["account_id"] == "account-1"
+
+
+def _metrics(envelopes):
+    return {
+        metric["name"]: metric["value"]
+        for e in envelopes
+        if e["data"]["baseType"] == "MetricData"
+        for metric in e["data"]["baseData"]["metrics"]
+    }
+
+
+def test_negative_metric_value_keeps_the_rest_of_the_interval(posted):
+    for value in (5, 3, -1, 4):
+        app_insights.track_metric("balance_delta", value)
+
+    app_insights.flush()
+
+    metrics = _metrics(posted)
+    assert metrics["balance_delta"] == 4
+    assert metrics["balance_delta/count"] == 4
+    assert metrics["balance_delta/sum"] == 11
+    assert metrics["balance_delta/max"] == 5
+    assert "balance_delta/min" not in metrics
+
+
+def test_shutdown_detaches_the_queue_handler(posted):
+    logger = app_insights.get_logger()
+    app_insights.shutdown()
+
+    assert app_insights.get_logger() is None
+    assert logger.handlers == []
+    # Ignored rather than queued where nothing exports it
+    app_insights.track_event("after-shutdown")
+
+    app_insights.init_app_insights()
+    assert len(app_insights.get_logger().handlers) == 1
+
+
+def test_metric_names_do_not_collide_with_derived_series(posted):
+    app_insights.track_metric("latency", 10)
+    app_insights.track_metric("latency_count", 7)
+    with pytest.raises(ValueError):
+        app_insights.track_metric("latency/count", 1)
+
+    app_insights.flush()
+
+    metrics = _metrics(posted)
+    assert metrics["latency/count"] == 1
+    assert metrics["latency_count"] == 7
+
+
+def test_reinit_after_shutdown_keeps_the_metric_flusher_running(posted):
+    app_insights.shutdown()
+    app_insights.init_app_insights()
+
+    # The previous flusher exits on its own stop event; the new one keeps running
+    time.sleep(0.1)
+    flushers = [t for t in threading.enumerate() if t.name == "app-insights-metrics"]
+    assert [t.is_alive() for t in flushers] == [True]
+
+
+def test_log_queue_overflow_is_counted(posted, monkeypatch):
+    # Restart with a small log queue so the backlog overflows it
+    app_insights.shutdown()
+    monkeypatch.setattr(app_insights, "_LOG_QUEUE_SIZE", 100)
+    app_insights.init_app_insights()
+
+    release = threading.Event()
+    fake_post = _opencensus._session.post
+
+    def slow_post(*args, **kwargs):
+        release.wait(10)
+        return fake_post(*args, **kwargs)
+
+    monkeypatch.setattr(_opencensus._session, "post", slow_post)
+
+    # Ingestion is stalled, so the handler's export queue fills up and
+    # everything past it and the 100-record log queue is dropped
+    for i in range(10000):
+        app_insights.track_trace(f"trace-{i}")
+    release.set()
+    app_insights.flush()
+
+    dropped = app_insights._log_queue.dropped
+    assert dropped > 0
+    assert len(_messages(posted)) == 10000 - dropped
+
+    metrics = _metrics(posted)
+    assert metrics["log_queue/dropped_total"] == dropped
+    assert metrics["log_queue/depth"] == 0
+    assert not any(name.startswith("log_queue/dropped_total/") for name in metrics)
+
+
+def test_propagated_context_follows_the_current_root(posted, monkeypatch):
+    from opencensus.trace.samplers import ProbabilitySampler
+
+    tracer = app_insights.get_tracer()
+
+    def traceparent():
+        return tracer.propagator.to_headers(tracer.span_context)["traceparent"]
+
+    sent = {}
+    for i in range(3):
+        # What the requests integration does for an outbound call
+        tracer.start_span(f"root-{i}")
+        sent[f"root-{i}"] = traceparent()
+        tracer.end_span()
+
+    monkeypatch.setattr(tracer, "sampler", ProbabilitySampler(rate=0.0))
+    tracer.start_span("dropped")
+    dropped = traceparent()
+    tracer.end_span()
+
+    app_insights.flush()
+
+    exported = {
+        e["data"]["baseData"]["name"]: (e["tags"]["ai.operation.id"], e["data"]["baseData"]["id"])
+        for e in posted
+        if e["data"]["baseType"] in ("RemoteDependencyData", "RequestData")
+    }
+    assert sorted(exported) == ["root-0", "root-1", "root-2"]
+    for name, (trace_id, span_id) in exported.items():
+        assert sent[name] == f"00-{trace_id}-{span_id}-01"
+    assert dropped.endswith("-00")
+
+
+def test_sampled_records_carry_their_sample_rate(posted, monkeypatch):
+    monkeypatch.setattr(app_insights, "_sample_rate", 0.25)
+    monkeypatch.setattr(app_insights.random, "random", lambda: 0.0)
+
+    app_insights.track_event("event")
+    app_insights.track_request("GET /ok", "/ok", 1.0, 200, True)
+    app_insights.track_request("GET /fail", "/fail", 1.0, 500, False)
+    app_insights.track_dependency("db", "SQL", "db", 1.0, True)
+    app_insights.track_trace("trace")
+
+    app_insights.flush()
+
+    rates = {
+        e["data"]["baseData"]["message"]: e.get("sampleRate")
+        for e in posted
+        if e["data"]["baseType"] == "MessageData"
+    }
+    assert rates == {
+        "Event: event": 25.0,
+        "Request: GET /ok": 25.0,
+        # Failed requests and unsampled kinds are kept regardless of rate
+        "Request: GET /fail": None,
+        "Dependency: db": 25.0,
+        "trace": None,
+    }
+
+
+@pytest.fixture
+def sample_rules(monkeypatch):
+    """Start each test with no per-endpoint sampling rules."""
+    monkeypatch.setattr(app_insights, "_endpoint_sample_rules", [])
+
+
+def _rules():
+    return [(rule.pattern, rate) for rule, rate in app_insights._endpoint_sample_rules]
+
+
+def test_parse_sample_rules():
+    rules = app_insights._parse_sample_rules(" ^/health$=0.01; ;^/a=b=2;no-rate;(=0.5;^/x=abc ")
+
+    # Rates are clamped, the last "=" splits, and invalid entries are skipped
+    assert [(rule.pattern, rate) for rule, rate in rules] == [("^/health$", 0.01), ("^/a=b", 1.0)]
+
+
+def test_sample_rules_merge_in_place(sample_rules):
+    app_insights.set_sample_rate("^/health$", 0.5)
+    app_insights.set_sample_rate("^/api/", 1.0)
+    app_insights._update_sample_rules(app_insights._parse_sample_rules("^/api/=0.2;^/new=0.3"))
+    app_insights.set_sample_rate("^/health$", -1)
+
+    assert _rules() == [("^/health$", 0.0), ("^/api/", 0.2), ("^/new", 0.3)]
+    assert app_insights._match_rate("/api/users") == 0.2
+    assert app_insights._match_rate("/other") == app_insights._sample_rate
+
+
+def test_env_sample_rules_are_merged_at_init(posted, sample_rules, monkeypatch):
+    app_insights.set_sample_rate("^/health$", 0.5)
+    app_insights.set_sample_rate("^/kept", 0.7)
+    monkeypatch.setenv("APPINSIGHTS_SAMPLING_RULES", "^/health$=0.01;^/api/=1.0")
+
+    app_insights.shutdown()
+    app_insights.init_app_insights()
+
+    assert _rules() == [("^/health$", 0.01), ("^/kept", 0.7), ("^/api/", 1.0)]
+
+
+class _URL:
+    """Stand-in for starlette's URL that counts full-URL renders."""
+
+    def __init__(self, path):
+        self.path = path
+        self.renders = 0
+
+    def __str__(self):
+        self.renders += 1
+        return f"https://app.example{self.path}?q=1"
+
+
+def _call_middleware(path, status_code=200, error=None, method="GET"):
+    request = SimpleNamespace(url=_URL(path), method=method)
+
+    async def call_next(request):
+        if error is not None:
+            raise error
+        return SimpleNamespace(status_code=status_code)
+
+    middleware = app_insights.get_fastapi_middleware()
+    try:
+        asyncio.run(middleware(request, call_next))
+    except Exception as e:
+        assert e is error
+    return request
+
+
+def _requests(envelopes):
+    return {
+        e["data"]["baseData"]["message"]: e
+        for e in envelopes
+        if e["data"]["baseData"].get("message", "").startswith("Request: ")
+    }
+
+
+def test_middleware_samples_per_endpoint(posted, sample_rules):
+    app_insights.set_sample_rate("^/health$", 0.0)
+    app_insights.set_sample_rate("^/api/", 1.0)
+
+    health = _call_middleware("/health")
+    api = _call_middleware("/api/users")
+    failed = _call_middleware("/health", status_code=503, method="POST")
+    error = RuntimeError("boom")
+    _call_middleware("/health", error=error, method="PUT")
+
+    app_insights.flush()
+
+    requests_ = _requests(posted)
+    assert sorted(requests_) == ["Request: GET /api/users", "Request: POST /health"]
+    properties = requests_["Request: GET /api/users"]["data"]["baseData"]["properties"]
+    assert properties["url"] == "https://app.example/api/users?q=1"
+    # Unsampled requests never render the full URL, even when tracked for failing
+    properties = requests_["Request: POST /health"]["data"]["baseData"]["properties"]
+    assert properties["url"] == "/health"
+    assert (health.url.renders, api.url.renders, failed.url.renders) == (0, 1, 0)
+
+    [exception] = [e for e in posted if e["data"]["baseType"] == "ExceptionData"]
+    properties = exception["data"]["baseData"]["properties"]
+    assert (properties["method"], properties["path"]) == ("PUT", "/health")
+
+
+def test_middleware_exports_the_endpoint_sample_rate(posted, sample_rules, monkeypatch):
+    app_insights.set_sample_rate("^/half$", 0.5)
+    monkeypatch.setattr(app_insights.random, "random", lambda: 0.0)
+
+    _call_middleware("/half")
+    _call_middleware("/half", status_code=500, method="POST")
+
+    app_insights.flush()
+
+    requests_ = _requests(posted)
+    assert requests_["Request: GET /half"]["sampleRate"] == 50.0
+    assert "sampleRate" not in requests_["Request: POST /half"]
+
+
+def test_flush_is_bounded_when_ingestion_stalls(posted, monkeypatch):
+    monkeypatch.setattr(app_insights, "_FLUSH_TIMEOUT", 1.0)
+    fake_post = _opencensus._session.post
+
+    def slow_post(*args, **kwargs):
+        time.sleep(0.2)
+        return fake_post(*args, **kwargs)
+
+    monkeypatch.setattr(_opencensus._session, "post", slow_post)
+
+    # Far more than the exporter can send within the flush timeout
+    for i in range(20000):
+        app_insights.track_trace(f"trace-{i}")
+
+    start = time.monotonic()
+    app_insights.flush()
+    elapsed = time.monotonic() - start
+
+    # The flush timeout, plus the in-flight post and the metrics export
+    assert elapsed < app_insights._FLUSH_TIMEOUT + 1.0
+    assert app_insights._log_handler.dropped > 0
+
+    # Tracking resumes once ingestion recovers
+    monkeypatch.setattr(_opencensus._session, "post", fake_post)
+    monkeypatch.setattr(app_insights, "_FLUSH_TIMEOUT", 5.0)
+    app_insights.track_event("after")
+    app_insights.flush()
+    assert "Event: after" in _messages(posted)
+
+
+def test_dropped_spans_support_the_span_api(posted, monkeypatch):
+    from opencensus.trace.samplers import ProbabilitySampler
+    from opencensus.trace.status import Status
+
+    monkeypatch.setattr(app_insights.get_tracer(), "sampler", ProbabilitySampler(rate=0.0))
+
+    with app_insights.start_span("root") as root:
+        with app_insights.start_span("child") as child:
+            for span in (root, child, child.span("grandchild")):
+                span.add_attribute("key", "value")
+                span.add_annotation("annotation")
+                span.set_status(Status(0))
+                span.span_kind = 1
+
+    app_insights.flush()
+
+    assert _span_names(posted) == []
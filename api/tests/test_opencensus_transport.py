@@ -0,0 +1,166 @@
+"""Status code handling of the gzip transport shared by the Azure exporters."""
+
+import gzip
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("opencensus.ext.azure")
+
+import requests  # noqa: E402
+from opencensus.ext.azure.common.transport import (  # noqa: E402
+    TransportMixin,
+    TransportStatusCode,
+)
+
+from lib.monitoring import _opencensus  # noqa: E402
+
+
+class _Storage:
+    def __init__(self):
+        self.batches = []
+
+    def put(self, batch, *args):
+        self.batches.append(batch)
+
+
+class _Transport(_opencensus.CompressedTransportMixin, TransportMixin):
+    def __init__(self):
+        self.options = SimpleNamespace(
+            endpoint="https://ingest.example",
+            timeout=10.0,
+            credential=None,
+            proxies=None,
+        )
+        self.storage = _Storage()
+        self._consecutive_redirects = 0
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    """Queue of responses (or exceptions) returned by the shared session."""
+    queued = []
+    calls = []
+
+    def fake_post(url, data, **kwargs):
+        calls.append((url, json.loads(gzip.decompress(data))))
+        response = queued.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(_opencensus._session, "post", fake_post)
+    return SimpleNamespace(queued=queued, calls=calls)
+
+
+def _response(status_code, body=None, headers=None):
+    return SimpleNamespace(
+        status_code=status_code,
+        headers=headers or {},
+        json=lambda: body,
+        text=json.dumps(body),
+    )
+
+
+@pytest.mark.parametrize(
+    "status_code, expected",
+    [
+        (200, TransportStatusCode.SUCCESS),
+        (400, TransportStatusCode.DROP),
+        (402, TransportStatusCode.DROP),
+        (429, TransportStatusCode.RETRY),
+        (500, TransportStatusCode.RETRY),
+        (503, TransportStatusCode.RETRY),
+    ],
+)
+def test_status_codes(responses, status_code, expected):
+    responses.queued.append(_response(status_code))
+
+    assert _Transport()._transmit([{"name": "a"}]) is expected
+    assert responses.calls == [("https://ingest.example/v2.1/track", [{"name": "a"}])]
+
+
+def test_connection_error_is_retried(responses):
+    responses.queued.append(requests.ConnectionError("refused"))
+
+    assert _Transport()._transmit([{"name": "a"}]) is TransportStatusCode.RETRY
+
+
+def test_partial_success_stores_only_retryable_envelopes(responses):
+    responses.queued.append(_response(206, {
+        "errors": [
+            {"index": 0, "statusCode": 400},
+            {"index": 2, "statusCode": 500},
+        ],
+    }))
+    transport = _Transport()
+
+    result = transport._transmit([{"n": 0}, {"n": 1}, {"n": 2}])
+
+    assert result is TransportStatusCode.DROP
+    assert transport.storage.batches == [[{"n": 2}]]
+
+
+def test_redirect_is_followed(responses):
+    responses.queued.append(_response(307, headers={"location": "https://moved.example/v2.1/track"}))
+    responses.queued.append(_response(200))
+    transport = _Transport()
+
+    assert transport._transmit([{"name": "a"}]) is TransportStatusCode.SUCCESS
+    assert transport.options.endpoint == "https://moved.example"
+    assert responses.calls[-1][0] == "https://moved.example/v2.1/track"
+
+
+def test_unserializable_values_are_stringified(responses):
+    responses.queued.append(_response(200))
+
+    assert _Transport()._transmit([{"value": object}]) is TransportStatusCode.SUCCESS
+    assert responses.calls[0][1] == [{"value": str(object)}]
+
+
+@pytest.mark.parametrize(
+    "status_code, level",
+    [
+        (400, "ERROR"),
+        (404, "ERROR"),
+        (439, "WARNING"),
+        (503, "WARNING"),
+    ],
+)
+def test_failed_requests_are_logged(responses, caplog, status_code, level):
+    responses.queued.append(_response(status_code, {"message": "bad ikey"}))
+
+    _Transport()._transmit([{"name": "a"}])
+
+    [record] = caplog.records
+    assert record.levelname == level
+    assert str(status_code) in record.getMessage()
+    assert "bad ikey" in record.getMessage()
+
+
+def test_connection_error_is_logged(responses, caplog):
+    responses.queued.append(requests.ConnectionError("refused"))
+
+    _Transport()._transmit([{"name": "a"}])
+
+    [record] = caplog.records
+    assert record.levelname == "WARNING"
+    assert "refused" in record.getMessage()
+
+
+def test_requests_are_counted_for_statsbeat(responses, monkeypatch):
+    from opencensus.ext.azure.common import transport as transport_module
+
+    requests_map = {}
+    monkeypatch.setattr(transport_module, "_requests_map", requests_map)
+    monkeypatch.setattr(_Transport, "_check_stats_collection", lambda self: True)
+    responses.queued.extend([_response(200), _response(400), _response(503)])
+
+    for _ in range(3):
+        _Transport()._transmit([{"name": "a"}])
+
+    assert requests_map["count"] == 3
+    assert requests_map["success"] == 1
+    assert requests_map["failure"] == {400: 1}
+    assert requests_map["retry"] == {503: 1}